@@ -1,8 +1,13 @@
+import functools
 import logging
+import struct
+import threading
 from contextlib import contextmanager
-from ctypes import byref, POINTER, cast, c_char_p
+from ctypes import (byref, POINTER, memmove, sizeof, addressof,
+                    string_at)
 
-import numpy as np
+# NumPy is only imported on first use (in the functions needing it) to keep
+# importing this module cheap
 
 from . import types
 from .types import *
@@ -49,6 +54,15 @@ class Error(Exception):
         raise cls(err)
 
 
+@functools.lru_cache(maxsize=512)
+def _get_string(typ, val):
+    string = POINTER(pichar)()
+    Error.check(Picam_GetEnumerationString(typ, val, byref(string)))
+    ret = string_at(addressof(string.contents)).decode()  # copies
+    Error.check(Picam_DestroyString(string))
+    return ret
+
+
 class Library:
     """PICam Library.
 
@@ -69,6 +83,7 @@ class Library:
 
     def uninitialize(self):
         logger.debug("uninitialize")
+        _get_string.cache_clear()
         Error.check(Picam_UninitializeLibrary())
 
     def __enter__(self):
@@ -82,25 +97,23 @@ class Library:
 
     @staticmethod
     def get_string(typ, val):
-        """Resolve a PICam enum to a human readable string"""
-        string = POINTER(pichar)()
-        Error.check(Picam_GetEnumerationString(typ, val, byref(string)))
-        ret = cast(string, c_char_p).value.decode()  # decode copies
-        Error.check(Picam_DestroyString(string))
-        return ret
+        """Resolve a PICam enum to a human readable string.
+
+        Results are cached until the library is uninitialized.
+        """
+        # normalize ctypes/NumPy integers to hashable ints for the cache
+        return _get_string(int(getattr(typ, "value", typ)),
+                           int(getattr(val, "value", val)))
 
     @staticmethod
     def get_strings(typ, val):
         """Resolve a PICam enumerated bitmask to a generator of strings for
         each bit set."""
-        mask = val
-        for i in range(32):
-            if not mask:
-                break
-            bit = mask & (1 << i)
-            if bit:
-                yield Library.get_string(typ, bit)
-                mask &= ~bit
+        mask = val & 0xffffffff
+        while mask:
+            bit = mask & -mask  # lowest set bit
+            yield Library.get_string(typ, bit)
+            mask ^= bit
 
     @staticmethod
     def get_enum(name):
@@ -108,6 +121,135 @@ class Library:
         return getattr(types, name)
 
 
+# typed getter/setter method names by parameter value type
+_GETTERS = {
+    PicamValueType_Integer: "get_int",
+    PicamValueType_Boolean: "get_int",
+    PicamValueType_Enumeration: "get_int",
+    PicamValueType_LargeInteger: "get_long",
+    PicamValueType_FloatingPoint: "get_float",
+    PicamValueType_Rois: "get_rois",
+    PicamValueType_Pulse: "get_pulse",
+    PicamValueType_Modulations: "get_modulations",
+}
+_SETTERS = {
+    PicamValueType_Integer: "set_int",
+    PicamValueType_Boolean: "set_int",
+    PicamValueType_Enumeration: "set_int",
+    PicamValueType_LargeInteger: "set_long",
+    PicamValueType_FloatingPoint: "set_float",
+    PicamValueType_Rois: "set_rois",
+    PicamValueType_Pulse: "set_pulse",
+    PicamValueType_Modulations: "set_modulations",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _roi_dtype():
+    """NumPy layout of PicamRoi matching the ((x, width, x_binning),
+    (y, height, y_binning)) tuples used by get_rois()/set_rois()"""
+    import numpy as np
+    dtype = np.dtype([
+        ("x", [("x", "i4"), ("width", "i4"), ("x_binning", "i4")]),
+        ("y", [("y", "i4"), ("height", "i4"), ("y_binning", "i4")]),
+    ])
+    assert dtype.itemsize == sizeof(PicamRoi)
+    return dtype
+
+
+@functools.lru_cache(maxsize=16)
+def _roi_struct(n):
+    """:class:`struct.Struct` packing `n` flattened PicamRoi"""
+    return struct.Struct("=" + "6i"*n)
+
+
+@functools.lru_cache(maxsize=None)
+def _firmware_detail_dtype():
+    """NumPy layout of PicamFirmwareDetail"""
+    import numpy as np
+    dtype = np.dtype([("name", "S64"), ("detail", "S256")])
+    assert dtype.itemsize == sizeof(PicamFirmwareDetail)
+    return dtype
+
+
+# PICam getter and output scalar type for the scalar value types
+_SCALAR_GETTERS = {
+    PicamValueType_Integer: (Picam_GetParameterIntegerValue, piint),
+    PicamValueType_Boolean: (Picam_GetParameterIntegerValue, piint),
+    PicamValueType_Enumeration: (Picam_GetParameterIntegerValue, piint),
+    PicamValueType_LargeInteger: (
+        Picam_GetParameterLargeIntegerValue, pi64s),
+    PicamValueType_FloatingPoint: (
+        Picam_GetParameterFloatingPointValue, piflt),
+}
+
+
+class _Scratch(threading.local):
+    """Per-thread scalar output arguments reused across calls.
+
+    The `*_ref` attributes are prebuilt :func:`ctypes.byref` references
+    to the scalars to be passed directly as output arguments.
+    """
+    def __init__(self):
+        self.int = piint()
+        self.int_ref = byref(self.int)
+        self.long = pi64s()
+        self.long_ref = byref(self.long)
+        self.flt = piflt()
+        self.flt_ref = byref(self.flt)
+        self.bln = pibln()
+        self.bln_ref = byref(self.bln)
+        self.value_type = PicamValueType()
+        self.value_type_ref = byref(self.value_type)
+        self.available_data = PicamAvailableData()
+        self.available_data_ref = byref(self.available_data)
+        self.errors = PicamAcquisitionErrorsMask()
+        self.errors_ref = byref(self.errors)
+        self.status = PicamAcquisitionStatus()
+        self.status_ref = byref(self.status)
+
+
+class _ReadoutBuffer:
+    """Expose the readouts in a :class:`PicamAvailableData` through the
+    NumPy array interface without an intermediate ctypes array.
+
+    Only the readout address is captured: like the PICam buffer it points
+    to, the view is valid until the next :meth:`Camera.acquire` or
+    :meth:`Camera.wait_for_acquisition_update`.
+    """
+    _attribute = "__array_interface__"
+
+    def __init__(self, data, readout_stride, dtype="u1"):
+        setattr(self, self._attribute,
+                self._interface(data, readout_stride, dtype))
+
+    @staticmethod
+    def _interface(data, readout_stride, dtype):
+        import numpy as np
+        dtype = np.dtype(dtype)
+        if readout_stride % dtype.itemsize:
+            raise ValueError("readout stride not a multiple of item size")
+        return {
+            "data": (data.initial_readout, False),
+            "shape": (data.readout_count, readout_stride//dtype.itemsize),
+            "typestr": dtype.str,
+            "strides": None,
+            "version": 3,
+        }
+
+
+class _CudaReadoutBuffer(_ReadoutBuffer):
+    """Expose the readouts in a :class:`PicamAvailableData` through the
+    CUDA array interface (see :meth:`Camera.get_data_cuda`)."""
+    _attribute = "__cuda_array_interface__"
+
+    @staticmethod
+    def _interface(data, readout_stride, dtype):
+        interface = _ReadoutBuffer._interface(data, readout_stride, dtype)
+        interface["stream"] = None
+        return interface
+
+
 class Camera:
     """PICam camera handle.
 
@@ -116,9 +258,21 @@ class Camera:
     """
     def __init__(self):
         self._handle = PicamHandle()
+        self._scratch = _Scratch()
+        # parameter value/enumerated/constraint types are fixed for an
+        # open handle
+        self._value_types = {}
+        self._enumerated_types = {}
+        self._constraint_types = {}
+
+    def _clear_caches(self):
+        self._value_types.clear()
+        self._enumerated_types.clear()
+        self._constraint_types.clear()
 
     def open_first(self):
         logger.debug("open_first")
+        self._clear_caches()
         Error.check(Picam_OpenFirstCamera(byref(self._handle)))
         return self
 
@@ -130,6 +284,7 @@ class Camera:
         return cid
 
     def open(self, cid):
+        self._clear_caches()
         Error.check(Picam_OpenCamera(cid, byref(self._handle)))
         return self
 
@@ -142,6 +297,7 @@ class Camera:
 
     def close(self):
         logger.debug("close")
+        self._clear_caches()
         Error.check(Picam_CloseCamera(self._handle))
 
     def get_id(self):
@@ -156,40 +312,48 @@ class Camera:
         details_count = piint()
         Error.check(Picam_GetFirmwareDetails(
             byref(cid), byref(details), byref(details_count)))
-        ret = [(details[i].name.decode(), details[i].detail.decode())
-               for i in range(details_count.value)]
+        ret = []
+        if details_count.value:
+            import numpy as np
+            mem = (pibyte*(details_count.value*sizeof(PicamFirmwareDetail))
+                   ).from_address(addressof(details.contents))
+            # like c_char arrays, cut at the first NUL; tolist() copies
+            ret = [(name.partition(b"\0")[0].decode(),
+                    detail.partition(b"\0")[0].decode())
+                   for name, detail in np.frombuffer(
+                       mem, dtype=_firmware_detail_dtype()).tolist()]
         Error.check(Picam_DestroyFirmwareDetails(details))
         return ret
 
     def get_int(self, parameter):
-        val = piint()
+        scratch = self._scratch
         Error.check(Picam_GetParameterIntegerValue(
-            self._handle, parameter, byref(val)))
-        return val.value
+            self._handle, parameter, scratch.int_ref))
+        return scratch.int.value
 
     def get_long(self, parameter):
-        val = pi64s()
+        scratch = self._scratch
         Error.check(Picam_GetParameterLargeIntegerValue(
-            self._handle, parameter, byref(val)))
-        return val.value
+            self._handle, parameter, scratch.long_ref))
+        return scratch.long.value
 
     def get_float(self, parameter):
-        val = piflt()
+        scratch = self._scratch
         Error.check(Picam_GetParameterFloatingPointValue(
-            self._handle, parameter, byref(val)))
-        return val.value
+            self._handle, parameter, scratch.flt_ref))
+        return scratch.flt.value
 
     def get_rois(self, parameter=PicamParameter_Rois):
         val = POINTER(PicamRois)()
         Error.check(Picam_GetParameterRoisValue(
             self._handle, parameter, byref(val)))
         vals = val.contents
-        roip = vals.roi_array
         rois = []
-        for i in range(vals.roi_count):
-            x = roip[i].x, roip[i].width, roip[i].x_binning
-            y = roip[i].y, roip[i].height, roip[i].y_binning
-            rois.append((x, y))
+        if vals.roi_count:
+            import numpy as np
+            mem = (pibyte*(vals.roi_count*sizeof(PicamRoi))).from_address(
+                addressof(vals.roi_array.contents))
+            rois = np.frombuffer(mem, dtype=_roi_dtype()).tolist()  # copies
         Error.check(Picam_DestroyRois(val))
         return rois
 
@@ -206,17 +370,33 @@ class Camera:
             self._handle, parameter, piflt(value)))
 
     def set_rois(self, parameter, value):
-        val = (PicamRoi*len(value))()
-        for i, (x, y) in enumerate(value):
-            val[i].x, val[i].width, val[i].x_binning = x
-            val[i].y, val[i].height, val[i].y_binning = y
+        n = len(value)
+        # only structured arrays matching PicamRoi are copied directly,
+        # a cast would broadcast plain arrays into every field
+        dtype = getattr(value, "dtype", None)
+        if (dtype is not None and dtype.names and dtype == _roi_dtype() and
+                value.shape == (n,)):
+            import numpy as np
+            rois = np.ascontiguousarray(value)
+            assert rois.nbytes == n*sizeof(PicamRoi)
+        else:
+            rois = _roi_struct(n).pack(*(
+                v for x, y in value for v in (*x, *y)))
+        val = (PicamRoi*n).from_buffer_copy(rois)
+        rois_struct = PicamRois(val, n)  # references val
         Error.check(Picam_SetParameterRoisValue(
-            self._handle, parameter, byref(PicamRois(val, len(value)))))
+            self._handle, parameter, byref(rois_struct)))
 
     def get_parameter_value_type(self, parameter):
-        typ = PicamValueType()
+        try:
+            return self._value_types[parameter]
+        except KeyError:
+            pass
+        scratch = self._scratch
         Error.check(Picam_GetParameterValueType(
-            self._handle, parameter, byref(typ)))
+            self._handle, parameter, scratch.value_type_ref))
+        typ = scratch.value_type
+        self._value_types[parameter] = typ.value
         return typ.value
 
     def get(self, parameter):
@@ -226,23 +406,11 @@ class Camera:
         the appropriate typed getter.
         """
         typ = self.get_parameter_value_type(parameter)
-        if typ in (
-                PicamValueType_Integer,
-                PicamValueType_Boolean,
-                PicamValueType_Enumeration):
-            return self.get_int(parameter)
-        elif typ == PicamValueType_LargeInteger:
-            return self.get_long(parameter)
-        elif typ == PicamValueType_FloatingPoint:
-            return self.get_float(parameter)
-        elif typ == PicamValueType_Rois:
-            return self.get_rois(parameter)
-        elif typ == PicamValueType_Pulse:
-            return self.get_pulse(parameter)
-        elif typ == PicamValueType_Modulations:
-            return self.get_modulations(parameter)
-        else:
+        try:
+            getter = _GETTERS[typ]
+        except KeyError:
             raise ValueError("unknown parameter value type")
+        return getattr(self, getter)(parameter)
 
     def set(self, parameter, value):
         """Set a parameter value.
@@ -251,30 +419,75 @@ class Camera:
         the appropriate typed setter.
         """
         typ = self.get_parameter_value_type(parameter)
-        if typ in (
-                PicamValueType_Integer,
-                PicamValueType_Boolean,
-                PicamValueType_Enumeration):
-            return self.set_int(parameter, value)
-        elif typ == PicamValueType_LargeInteger:
-            return self.set_long(parameter, value)
-        elif typ == PicamValueType_FloatingPoint:
-            return self.set_float(parameter, value)
-        elif typ == PicamValueType_Rois:
-            return self.set_rois(parameter, value)
-        elif typ == PicamValueType_Pulse:
-            return self.set_pulse(parameter, value)
-        elif typ == PicamValueType_Modulations:
-            return self.set_modulations(parameter, value)
-        else:
+        try:
+            setter = _SETTERS[typ]
+        except KeyError:
             raise ValueError("unknown parameter value type")
+        return getattr(self, setter)(parameter, value)
+
+    def get_all(self, parameters=None):
+        """Get multiple parameter values.
+
+        Returns a dictionary mapping parameters to their values. Only one
+        PICam call per parameter is needed once its value type is cached.
+        Dispatches to the typed getters directly, not through :meth:`get`.
+
+        Args:
+            parameters (list): Parameters to get. Defaults to all
+                :meth:`get_parameters` that have a typed getter (Pulse and
+                Modulations parameters are skipped).
+        """
+        skip = parameters is None
+        if skip:
+            parameters = self.get_parameters()
+        values = {}
+        for parameter in parameters:
+            typ = self.get_parameter_value_type(parameter)
+            try:
+                getter = getattr(self, _GETTERS[typ])
+            except (KeyError, AttributeError):
+                if skip:
+                    continue
+                raise ValueError("unknown parameter value type")
+            values[parameter] = getter(parameter)
+        return values
+
+    def make_getter(self, parameter):
+        """Return a function without arguments getting a parameter value.
+
+        The parameter value type is resolved once and scalar values are
+        read directly into a scalar owned by the returned function. It is
+        only valid while the camera stays open and must not be shared
+        between threads.
+        """
+        typ = self.get_parameter_value_type(parameter)
+        try:
+            picam_get, scalar = _SCALAR_GETTERS[typ]
+        except KeyError:
+            if typ not in _GETTERS:
+                raise ValueError("unknown parameter value type")
+            return functools.partial(getattr(self, _GETTERS[typ]), parameter)
+        handle = self._handle
+        val = scalar()
+        ref = byref(val)
+
+        def get():
+            Error.check(picam_get(handle, parameter, ref))
+            return val.value
+        return get
 
     def get_parameters(self):
         parameters = POINTER(PicamParameter)()
         parameters_count = piint()
         Error.check(Picam_GetParameters(
             self._handle, byref(parameters), byref(parameters_count)))
-        params = parameters[:parameters_count.value]  # copies
+        params = []
+        if parameters_count.value:
+            import numpy as np
+            mem = (pibyte*(parameters_count.value*sizeof(PicamParameter))
+                   ).from_address(addressof(parameters.contents))
+            params = np.frombuffer(
+                mem, dtype=np.dtype(PicamParameter)).tolist()  # copies
         Error.check(Picam_DestroyParameters(parameters))
         return params
 
@@ -285,15 +498,25 @@ class Camera:
         return val.value
 
     def get_parameter_enumerated_type(self, parameter):
+        try:
+            return self._enumerated_types[parameter]
+        except KeyError:
+            pass
         val = PicamEnumeratedType()
         Error.check(Picam_GetParameterEnumeratedType(
             self._handle, parameter, byref(val)))
+        self._enumerated_types[parameter] = val.value
         return val.value
 
     def get_parameter_constraint_type(self, parameter):
+        try:
+            return self._constraint_types[parameter]
+        except KeyError:
+            pass
         val = piint()
         Error.check(Picam_GetParameterConstraintType(
             self._handle, parameter, byref(val)))
+        self._constraint_types[parameter] = val.value
         return val.value
 
     def get_parameter_range_constraint(
@@ -315,10 +538,10 @@ class Camera:
         return constraint
 
     def comitted(self):
-        ret = pibln()
+        scratch = self._scratch
         Error.check(Picam_AreParametersCommitted(
-            self._handle, byref(ret)))
-        return ret.value
+            self._handle, scratch.bln_ref))
+        return scratch.bln.value
 
     def commit(self):
         failed = POINTER(PicamParameter)()
@@ -334,13 +557,19 @@ class Camera:
             Error.check(Picam_DestroyParameters(failed))
 
     def acquire(self, readout_count=1, timeout=-1):
-        data = PicamAvailableData()
-        errors = PicamAcquisitionErrorsMask()
+        """Acquire readouts.
+
+        The returned :class:`PicamAvailableData` and
+        :class:`PicamAcquisitionErrorsMask` (like the data they refer to)
+        are reused and only valid until the next :meth:`acquire` or
+        :meth:`wait_for_acquisition_update` in the same thread.
+        """
+        scratch = self._scratch
         logger.debug("acquire")
         Error.check(Picam_Acquire(
-            self._handle, readout_count, timeout, byref(data), byref(errors)))
-        # data valid until the next acquire() or wait_for_acquisition_update()
-        return data, errors
+            self._handle, readout_count, timeout,
+            scratch.available_data_ref, scratch.errors_ref))
+        return scratch.available_data, scratch.errors
 
     def start_acquisition(self):
         logger.debug("start acquisition")
@@ -351,16 +580,28 @@ class Camera:
         Error.check(Picam_StopAcquisition(self._handle))
 
     def wait_for_acquisition_update(self, timeout=-1):
-        data = PicamAvailableData()
-        status = PicamAcquisitionStatus()
+        """Wait for an acquisition update.
+
+        The returned :class:`PicamAvailableData` and
+        :class:`PicamAcquisitionStatus` (like the data they refer to)
+        are reused and only valid until the next :meth:`acquire` or
+        :meth:`wait_for_acquisition_update` in the same thread.
+        """
+        scratch = self._scratch
         Error.check(Picam_WaitForAcquisitionUpdate(
-            self._handle, timeout, byref(data), byref(status)))
-        # data valid until the next acquire() or wait_for_acquisition_update()
-        return data, status
+            self._handle, timeout,
+            scratch.available_data_ref, scratch.status_ref))
+        return scratch.available_data, scratch.status
 
     @contextmanager
     def acquisition(self):
-        """Context manager for around StartAcquisition()/StopAcquisition()"""
+        """Context manager for around StartAcquisition()/StopAcquisition()
+
+        The PICam functions are called through :class:`ctypes.CDLL`, which
+        releases the GIL for the duration of each call. Other Python
+        threads keep running while :meth:`wait_for_acquisition_update`
+        or :meth:`acquire` block.
+        """
         self.start_acquisition()
         try:
             yield
@@ -368,15 +609,56 @@ class Camera:
             self.stop_acquisition()
 
     @staticmethod
-    def get_data(data, readout_stride):
+    def get_data(data, readout_stride, out=None, dtype="u1"):
         """Convert :class:`PicamAvailableData` into NumPy array.
 
+        Without `out`, the returned array is a view of the PICam buffer
+        and is only valid until the next :meth:`acquire` or
+        :meth:`wait_for_acquisition_update`. With `out`, the readouts are
+        copied into it and it is returned.
+
         Args:
             data (:class:`PicamAvailableData`): Data to be converted.
             readout_stride (int): ReadoutStride parameter.
+            out (ndarray): Optional C-contiguous destination array of at
+                least `readout_count*readout_stride` bytes.
+            dtype: Pixel data type of the returned view, e.g. `"<u2"`.
+                Ignored if `out` is given.
+        """
+        if not data or not data.initial_readout or not data.readout_count:
+            raise ValueError("empty data")
+        if out is None:
+            import numpy as np
+            return np.asarray(_ReadoutBuffer(data, readout_stride, dtype))
+        size = data.readout_count*readout_stride
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise ValueError("out must be writeable and C-contiguous")
+        if out.nbytes < size:
+            raise ValueError("out too small")
+        memmove(out.ctypes.data, data.initial_readout, size)
+        return out
+
+    @staticmethod
+    def get_data_cuda(data, readout_stride, dtype="u1"):
+        """Expose :class:`PicamAvailableData` to CUDA consumers.
+
+        Returns an object implementing `__cuda_array_interface__` that
+        CuPy, Numba or PyTorch can wrap without a host to device copy.
+        The host address of the readouts is exported as the device
+        pointer. This is only valid if the PICam acquisition buffer has
+        been page-locked and mapped beforehand with
+        `cudaHostRegister(ptr, size, cudaHostRegisterMapped)` and the
+        device reports `cudaDevAttrCanUseHostPointerForRegisteredMem`.
+        Otherwise the device pointer differs and has to be obtained with
+        `cudaHostGetDevicePointer` instead. Like :meth:`get_data`, the
+        result is only valid until the next :meth:`acquire` or
+        :meth:`wait_for_acquisition_update`.
+
+        Args:
+            data (:class:`PicamAvailableData`): Data to be exposed.
+            readout_stride (int): ReadoutStride parameter.
+            dtype: Pixel data type, e.g. `"<u2"`.
         """
         if not data or not data.initial_readout or not data.readout_count:
             raise ValueError("empty data")
-        mem = (pibyte*(data.readout_count*readout_stride)).from_address(
-            data.initial_readout)
-        return np.ctypeslib.as_array(mem).reshape(data.readout_count, -1)
+        return _CudaReadoutBuffer(data, readout_stride, dtype)